@@ -6,14 +6,13 @@ __version__ = '0.1.0'
 
 
 import ast
-from dataclasses import dataclass
-import itertools
-import math
+from collections import deque
+from dataclasses import dataclass, field
+import functools
 import os
 import sys
-from pathlib import Path
-from types import TracebackType
-from typing import IO, Literal, Optional
+from types import CodeType, TracebackType
+from typing import IO, Iterator, Literal, Optional
 
 
 # TODO: Better checks
@@ -26,7 +25,7 @@ from typing import IO, Literal, Optional
 # TODO: Better highlighting using ast data (e.g. only highlight first line of for loop)
 
 
-@dataclass(slots=True)
+@dataclass(frozen=True, slots=True)
 class EscapeSequences:
   bright_black: str
   italic: str
@@ -34,69 +33,162 @@ class EscapeSequences:
   reset: str
   underline: str
 
-  def __init__(self, file: IO, *, disable_color: bool = False):
-    if not (disable_color or not file.isatty() or os.environ.get('NO_COLOR')):
-      self.bright_black = '\033[90m'
-      self.italic = '\033[3m'
-      self.red = '\033[31m'
-      self.reset = '\033[0m'
-      self.underline = '\033[4m'
-    else:
-      self.bright_black = ''
-      self.italic = ''
-      self.red = ''
-      self.reset = ''
-      self.underline = ''
+ESCAPE_SEQUENCES_COLOR = EscapeSequences(
+  bright_black='\033[90m',
+  italic='\033[3m',
+  red='\033[31m',
+  reset='\033[0m',
+  underline='\033[4m'
+)
+
+ESCAPE_SEQUENCES_NO_COLOR = EscapeSequences(
+  bright_black='',
+  italic='',
+  red='',
+  reset='',
+  underline=''
+)
+
+def get_escape_sequences(file: IO, *, disable_color: bool = False):
+  # Objects that only implement write() are treated as non-terminals
+  isatty = getattr(file, 'isatty', None)
+
+  if disable_color or (isatty is None) or not isatty() or os.environ.get('NO_COLOR'):
+    return ESCAPE_SEQUENCES_NO_COLOR
 
+  return ESCAPE_SEQUENCES_COLOR
 
-def get_integer_width(x: int, /):
-  return max(math.ceil(math.log10(x + 1)), 1)
 
 def get_line_indentation(line: str, /):
   return len(line) - len(line.lstrip())
 
 def get_common_indentation(lines: list[str], /):
-  return min(len(line) - len(stripped_line) for line in lines if (stripped_line := line.lstrip()))
+  common_indentation: Optional[int] = None
 
+  for line in lines:
+    if (stripped_line := line.lstrip()):
+      indentation = len(line) - len(stripped_line)
 
-def identify_node(mod: ast.Module, line_start: int, line_end: int, col_start: int, col_end: int) -> ast.Module | ast.expr | ast.stmt:
-  best_candidate: ast.Module | ast.expr | ast.stmt = mod
+      # No other line can lower the result
+      if indentation == 0:
+        return 0
 
-  def node_matches(node: ast.expr | ast.stmt):
-    assert node.end_lineno is not None
+      if (common_indentation is None) or (indentation < common_indentation):
+        common_indentation = indentation
 
-    # TODO: Improve to support columns
-    return (node.lineno <= line_start) and (node.end_lineno >= line_end)
+  return common_indentation or 0
 
-  while True:
-    new_candidates = list[ast.expr | ast.stmt]()
-
-    match best_candidate:
-      case ast.ClassDef(body=body):
-        new_candidates += body
-      case ast.ExceptHandler(type, name, body):
-        new_candidates += [type, *body]
-      case ast.Expr(value):
-        new_candidates.append(value)
-      case ast.AsyncFunctionDef(body=body) | ast.FunctionDef(body=body):
-        new_candidates += body
-      case ast.If(test, body, orelse):
-        new_candidates += [test, *body, *orelse]
-      case ast.Module(body=body):
-        new_candidates += body
-      case ast.For(target, iter, body, orelse, type_comment):
-        new_candidates += [target, iter, *body, *orelse]
-      case ast.Try(body, handlers, orelse, finalbody) | ast.TryStar(body, handlers, orelse, finalbody):
-        new_candidates += [*body, *handlers, *orelse, *finalbody]
-      case _:
-        return best_candidate
-
-    candidates_matching = [candidate for candidate in new_candidates if node_matches(candidate)]
-
-    if len(candidates_matching) == 1:
-      best_candidate = candidates_matching[0]
-    else:
-      return best_candidate # type: ignore
+def get_path_prefix(path: str, /):
+  # Normalized absolute path with a trailing separator, to be tested with str.startswith() against a normcase'd path
+  return os.path.normcase(os.path.join(os.path.abspath(path), ''))
+
+def get_sys_path_prefixes(sys_paths: list[str], /):
+  # Longest prefixes first so that nested entries (e.g. a virtual environment inside the project) take precedence
+  return tuple(sorted(dict.fromkeys(get_path_prefix(sys_path) for sys_path in sys_paths), key=len, reverse=True))
+
+def starts_with_raise(code: str, /):
+  return code.startswith('raise') and not (code[5:6].isalnum() or code[5:6] == '_')
+
+
+def read_source(path: str, /):
+  # Unbuffered binary reads skip the buffer and text wrapper setup, and readall() sizes its buffer from fstat()
+  with open(path, 'rb', buffering=0) as file:
+    return file.read().decode('utf-8', 'replace')
+
+@dataclass(frozen=True, slots=True)
+class Source:
+  contents: str
+  lines: list[str]
+  blank_lines: list[bool]
+
+# The modification time and size are part of the key so that edited files are read again, as with linecache.checkcache()
+# The cache is bounded as the hook may be installed in long-running processes
+@functools.lru_cache(maxsize=256)
+def load_source(path: str, mtime_ns: int, size: int, /):
+  contents = read_source(path)
+  lines = contents.splitlines()
+
+  return Source(contents, lines, [not line or line.isspace() for line in lines])
+
+def get_source(path: str, /):
+  try:
+    stat = os.stat(path)
+    return load_source(path, stat.st_mtime_ns, stat.st_size)
+  except OSError:
+    return None
+
+
+ModuleKind = Literal['internal', 'lib', 'std', 'user']
+Positions = tuple[Optional[int], Optional[int], Optional[int], Optional[int]]
+
+@dataclass(slots=True)
+class Cache:
+  cwd_prefix: str = field(default_factory=(lambda: get_path_prefix(os.getcwd())))
+  sys_path_prefixes: tuple[str, ...] = field(default_factory=(lambda: get_sys_path_prefixes(sys.path)))
+
+  modules: dict[str, ast.Module] = field(default_factory=dict)
+  nodes: dict[tuple[str, int, int, int, int], ast.AST] = field(default_factory=dict)
+
+
+# Code objects compare by value, including their location table, hence equal keys always have equal positions
+@functools.lru_cache(maxsize=512)
+def get_code_positions(code: CodeType, /) -> list[Positions]:
+  return list(code.co_positions())
+
+
+# The path prefixes are part of the key as sys.path and the working directory may change between dumps
+@functools.lru_cache(maxsize=4096)
+def locate_module(raw_path: str, cwd_prefix: str, sys_path_prefixes: tuple[str, ...]) -> tuple[str, ModuleKind]:
+  norm_path = os.path.normpath(raw_path)
+
+  # Paths are case-insensitive on Windows, the original case is kept for display
+  cased_path = os.path.normcase(norm_path)
+
+  for sys_path_prefix in sys_path_prefixes:
+    if cased_path.startswith(sys_path_prefix):
+      rel_path = norm_path[len(sys_path_prefix):].removesuffix('.py')
+      module_name = rel_path.replace(os.sep, '.')
+
+      # Only the top-level package is needed to recognize the standard library
+      if rel_path.partition(os.sep)[0] in sys.stdlib_module_names:
+        return module_name, 'std'
+      elif cased_path.startswith(cwd_prefix):
+        return module_name, 'user'
+      else:
+        return module_name, 'lib'
+
+  return raw_path, 'user'
+
+
+def identify_node(mod: ast.Module, line_start: int, line_end: int, col_start: int, col_end: int) -> ast.AST:
+  # Find the innermost node spanning the target lines, only descending into nodes which span them
+
+  best_candidate: ast.AST = mod
+  best_lineno = 0
+  best_end_lineno = sys.maxsize
+
+  parents: list[ast.AST] = [mod]
+
+  while parents:
+    for node in ast.iter_child_nodes(parents.pop()):
+      lineno = getattr(node, 'lineno', None)
+      end_lineno = getattr(node, 'end_lineno', None)
+
+      # Nodes without a location (e.g. ast.arguments or ast.match_case) may still contain matching nodes
+      if (lineno is None) or (end_lineno is None):
+        parents.append(node)
+        continue
+
+      # TODO: Improve to support columns
+      if (lineno <= line_start) and (end_lineno >= line_end):
+        parents.append(node)
+
+        if (lineno > best_lineno) or ((lineno == best_lineno) and (end_lineno < best_end_lineno)):
+          best_candidate = node
+          best_lineno = lineno
+          best_end_lineno = end_lineno
+
+  return best_candidate
 
 
 @dataclass(kw_only=True, slots=True)
@@ -108,70 +200,54 @@ class Options:
   remove_common_indentation: bool = True
 
 
-def format_frame(
+# Beyond the innermost one, only frames with an index lower than this one may be displayed with their source
+TRACED_FRAME_COUNT = 3
+
+def write_frame(
+    output: list[str],
+    *,
     escape: EscapeSequences,
     frame_index: int,
     func_name: str,
     raw_path: str,
-    positions: Optional[tuple[Optional[int], Optional[int], Optional[int], Optional[int]]],
+    line_number: Optional[int],
+    positions: Optional[Positions],
     prefix: str,
-    options: Options
+    options: Options,
+    cache: Cache
   ):
   is_reraise = False
-  trace = None
+  source: Optional[Source] = None
 
-  if raw_path[0] == '<':
+  # Also covers code compiled with an empty file name
+  if (not raw_path) or raw_path.startswith('<'):
     kind = 'internal'
     module_name = raw_path
   else:
     # Locate module
 
-    frame_path = Path(raw_path)
-
-    for sys_path in sys.path:
-      try:
-        rel_path = frame_path.relative_to(sys_path)
-      except ValueError:
-        pass
-      else:
-        *directories, file_name = rel_path.parts
-
-        module_path = directories + [file_name.removesuffix('.py')]
-        module_name = '.'.join(module_path)
-
-        if module_path[0] in sys.stdlib_module_names:
-          kind = 'std'
-        else:
-          try:
-            frame_path.relative_to(Path.cwd())
-          except ValueError:
-            kind = 'lib'
-          else:
-            kind = 'user'
-
-        break
-    else:
-      kind = 'user'
-      module_name = raw_path
+    module_name, kind = locate_module(raw_path, cache.cwd_prefix, cache.sys_path_prefixes)
 
 
     if (frame_index == 0) or (
       (kind == 'user') and
-      (frame_index < 3)
+      (frame_index < TRACED_FRAME_COUNT)
     ):
-      # Produce trace
+      # Load source
 
       if positions is not None:
-        try:
-          frame_contents = frame_path.read_text()
-        except OSError:
-          frame_contents = None
+        source = get_source(raw_path)
 
-        if frame_contents is not None:
+        # The file may have been shortened since the code was compiled
+        if (source is not None) and (positions[1] is not None) and (positions[1] > len(source.lines)):
+          source = None
+
+        if source is not None:
           # Obtain target line range
 
+          frame_contents = source.contents
+          code_lines = source.lines
           line_start, line_end, col_start, col_end = positions
-          code_lines = frame_contents.splitlines()
 
           # Line numbers start at 1
           assert (line_start is not None) and (line_end is not None) and (col_start is not None) and (col_end is not None)
@@ -180,168 +256,191 @@ def format_frame(
           # Detect re-raise
 
           if frame_index > 0:
-            mod = ast.parse(frame_contents)
-            node = identify_node(mod, line_start, line_end, col_start, col_end)
-            is_reraise = isinstance(node, ast.Raise)
+            # Avoid parsing the module when the answer is obvious from the source text
+            # A Raise node can only be identified if it starts on the first target line
+            if 'raise' not in code_lines[line_start - 1]:
+              is_reraise = False
+            elif starts_with_raise(code_lines[line_start - 1][col_start:]):
+              is_reraise = True
+            else:
+              # Recursive calls produce the same positions many times
+              node_key = (raw_path, line_start, line_end, col_start, col_end)
+              node = cache.nodes.get(node_key)
+
+              if node is None:
+                mod = cache.modules.get(raw_path)
+
+                if mod is None:
+                  mod = ast.parse(frame_contents)
+                  cache.modules[raw_path] = mod
 
+                node = identify_node(mod, line_start, line_end, col_start, col_end)
+                cache.nodes[node_key] = node
 
-          # Compute target line range
+              is_reraise = isinstance(node, ast.Raise)
 
-          # Ensure there are no more than max_total_lines target lines
-          if line_end - line_start + 1 > options.max_target_lines:
-            # The "more lines" message always mentions at least 2 lines
-            line_end_cut = line_start + options.max_target_lines - 2
-          else:
-            line_end_cut = line_end
 
-          # Old version
-          # line_end_cut = line_start + min(line_end - line_start, max_target_lines - 1)
+  # Write header
 
+  color = escape.bright_black if (kind != 'user') and (frame_index != 0) else ''
+  underline = escape.underline if source is not None else ''
+  location = f'{module_name}:{line_number}' if (kind != 'internal') and (line_number is not None) else module_name
+  reraise = ' [re-raise]' if is_reraise else ''
 
-          # Compute context line range
+  output.append(f'{prefix}{color}  at {underline}{func_name}{escape.reset}{color} ({location}){reraise}{escape.reset}\n')
 
-          context_line_start = max(line_start - options.max_context_lines_before, 1)
-          context_line_end = min(line_end + options.max_context_lines_after, len(code_lines))
 
-          while (context_line_start < line_start) and (not (context_line := code_lines[context_line_start - 1]) or context_line.isspace()):
-            context_line_start += 1
+  # Write trace
 
-          # This must be done beforehand in order to calculate the maximum line width
-          while (context_line_end > line_end) and (not (context_line := code_lines[context_line_end - 1]) or context_line.isspace()):
-            context_line_end -= 1
+  if source is not None:
+    # Compute target line range
 
+    # Ensure there are no more than max_total_lines target lines
+    if line_end - line_start + 1 > options.max_target_lines:
+      # The "more lines" message always mentions at least 2 lines
+      line_end_cut = line_start + options.max_target_lines - 2
+    else:
+      line_end_cut = line_end
 
-          # Compute line parameters
+    # Old version
+    # line_end_cut = line_start + min(line_end - line_start, max_target_lines - 1)
 
-          # Also includes cut target lines
-          displayed_lines = code_lines[(context_line_start - 1):context_line_end]
-          common_indentation = get_common_indentation(displayed_lines) if options.remove_common_indentation else 0
 
-          line_number_width = get_integer_width(context_line_end)
+    # Compute context line range
 
+    context_line_start = max(line_start - options.max_context_lines_before, 1)
+    context_line_end = min(line_end + options.max_context_lines_after, len(code_lines))
 
-          # Display context before target
+    blank_lines = source.blank_lines
 
-          indent = ' ' * 4
-          trace = f''
+    while (context_line_start < line_start) and blank_lines[context_line_start - 1]:
+      context_line_start += 1
 
-          for rel_line_index, line in enumerate(code_lines[(context_line_start - 1):(line_start - 1)]):
-            line_number = context_line_start + rel_line_index
-            trace += f'{prefix}{escape.bright_black}{indent}{line_number: >{line_number_width}} {line[common_indentation:]}{escape.reset}\n'
+    # This must be done beforehand in order to calculate the maximum line width
+    while (context_line_end > line_end) and blank_lines[context_line_end - 1]:
+      context_line_end -= 1
 
 
-          # Display target
+    # Compute line parameters
 
-          target_lines = code_lines[(line_start - 1):line_end_cut]
+    # Also includes cut target lines
+    displayed_lines = code_lines[(context_line_start - 1):context_line_end]
+    common_indentation = get_common_indentation(displayed_lines) if options.remove_common_indentation else 0
 
-          for rel_line_index, line in enumerate(target_lines):
-            line_number = line_start + rel_line_index
-            line_indent = (get_line_indentation(line) if options.skip_indentation_highlight else 0)
+    # Line numbers are positive
+    line_number_width = len(str(context_line_end))
 
-            if line_number == line_start:
-              anchor_start = col_start
 
-              if line_start == line_end:
-                anchor_end = col_end
-              else:
-                anchor_end = len(line) - col_start
-            elif line_number == line_end:
-              anchor_start = line_indent
-              anchor_end = col_end
-            else:
-              anchor_start = line_indent
-              anchor_end = len(line)
+    # Display context before target
 
-            anchor_start_sub = max(anchor_start - common_indentation, 0)
-            anchor_end_sub = max(anchor_end - common_indentation, 0)
+    indent = ' ' * 4
 
-            trace += f'{prefix}{indent}{line_number: >{line_number_width}} {line[common_indentation:]}\n'
-            trace += prefix + indent + ' ' * (line_number_width + 1 + anchor_start_sub)
-            trace += escape.red
-            trace += '^' * (anchor_end_sub - anchor_start_sub)
-            trace += escape.reset + '\n'
+    context_line_format = f'{prefix}{escape.bright_black}{indent}%{line_number_width}d %s{escape.reset}\n'
+    target_line_format = f'{prefix}{indent}%{line_number_width}d %s\n'
 
-          if line_end_cut != line_end:
-            trace += f'{prefix}{indent}{' ' * (line_number_width + 1)}[{line_end - line_end_cut} more lines]\n'
+    # Aligned with the start of source lines
+    code_indent = f'{prefix}{indent}{' ' * (line_number_width + 1)}'
+    anchor_line_format = f'{code_indent}%s{escape.red}%s{escape.reset}\n'
 
+    for line_number in range(context_line_start, line_start):
+      output.append(context_line_format % (line_number, code_lines[line_number - 1][common_indentation:]))
 
-          # Display context after target
 
-          for rel_line_index, line in enumerate(code_lines[line_end:context_line_end]):
-            line_number = line_end + rel_line_index + 1
-            trace += f'{prefix}{escape.bright_black}{indent}{line_number: >{line_number_width}} {line[common_indentation:]}{escape.reset}\n'
+    # Display target
 
-          trace += f'{prefix}\n'
+    for line_number in range(line_start, line_end_cut + 1):
+      line = code_lines[line_number - 1]
 
-  color = escape.bright_black if (kind != 'user') and (frame_index != 0) else ''
+      if line_number == line_start:
+        anchor_start = col_start
+
+        if line_start == line_end:
+          anchor_end = col_end
+        else:
+          anchor_end = len(line) - col_start
+      else:
+        # Only needed for continuation lines, which are not the common case
+        anchor_start = get_line_indentation(line) if options.skip_indentation_highlight else 0
+        anchor_end = col_end if line_number == line_end else len(line)
+
+      anchor_start_sub = max(anchor_start - common_indentation, 0)
+      anchor_end_sub = max(anchor_end - common_indentation, 0)
+
+      output.append(target_line_format % (line_number, line[common_indentation:]))
+      output.append(anchor_line_format % (' ' * anchor_start_sub, '^' * (anchor_end_sub - anchor_start_sub)))
 
-  return f'{prefix}{color}  at {escape.underline if trace is not None else ''}{func_name}{escape.reset}'\
-    + f'{color} ({module_name}{f':{positions[0]}' if (kind != 'internal') and (positions is not None) and (positions[0] is not None) else ''})'\
-    + f'{' [re-raise]' if is_reraise else ''}{escape.reset}\n' + (trace or '')
+    if line_end_cut != line_end:
+      output.append(f'{code_indent}[{line_end - line_end_cut} more lines]\n')
 
 
-def write_exc(start_exc: BaseException, file: IO[str], *, escape: EscapeSequences, options: Options, prefix: str):
+    # Display context after target
+
+    for line_number in range(line_end + 1, context_line_end + 1):
+      output.append(context_line_format % (line_number, code_lines[line_number - 1][common_indentation:]))
+
+    output.append(f'{prefix}\n')
+
+
+def write_exc(start_exc: BaseException, output: list[str], *, escape: EscapeSequences, options: Options, prefix: str, cache: Cache):
   screen_width = 80
 
   if isinstance(start_exc, (BaseExceptionGroup, ExceptionGroup)):
-    write_exc_core(start_exc, file, escape=escape, options=options, prefix=f' | {prefix}', prefix_first=f'{prefix} + ')
+    write_exc_core(start_exc, output, escape=escape, options=options, prefix=f' | {prefix}', prefix_first=f'{prefix} + ', cache=cache)
 
     line = f'{prefix} +--+'
-    file.write(f'{line}{'-' * (screen_width - len(line))}\n')
+    output.append(f'{line}{'-' * (screen_width - len(line))}\n')
 
     for exc in start_exc.exceptions:
-      write_exc(exc, file, escape=escape, options=options, prefix=f'    | {prefix}')
+      write_exc(exc, output, escape=escape, options=options, prefix=f'    | {prefix}', cache=cache)
 
       line = f'{prefix}    +'
-      file.write(f'{line}{'-' * (screen_width - len(line))}\n')
+      output.append(f'{line}{'-' * (screen_width - len(line))}\n')
   else:
-    write_exc_core(start_exc, file, escape=escape, options=options, prefix=prefix, prefix_first=prefix)
+    write_exc_core(start_exc, output, escape=escape, options=options, prefix=prefix, prefix_first=prefix, cache=cache)
 
 
-def write_exc_core(start_exc: BaseException, file: IO[str], *, escape: EscapeSequences, options: Options, prefix: str, prefix_first: str):
-  # List exceptions
-
+def iter_exc_chain(start_exc: BaseException, /) -> Iterator[tuple[BaseException, Literal['base', 'cause', 'context']]]:
   current_exc = start_exc
-  excs = list[tuple[BaseException, Literal['base', 'cause', 'context']]]()
-  excs.append((current_exc, 'base'))
+  yield current_exc, 'base'
 
   while True:
     if current_exc.__cause__:
       current_exc = current_exc.__cause__
-      excs.append((current_exc, 'cause'))
+      yield current_exc, 'cause'
     elif current_exc.__context__:
       current_exc = current_exc.__context__
-      excs.append((current_exc, 'context'))
+      yield current_exc, 'context'
     else:
       break
 
 
-  # Print exceptions
+def write_exc_core(start_exc: BaseException, output: list[str], *, escape: EscapeSequences, options: Options, prefix: str, prefix_first: str, cache: Cache):
+  # Print exceptions, following the chain as it is written
 
-  for exc, exc_kind in excs:
+  for exc, exc_kind in iter_exc_chain(start_exc):
     # Write possible cause or context explanation
 
     match exc_kind:
       case 'base':
         pass
       case 'cause':
-        file.write(f'{prefix}\n{escape.italic}[Caused by]{escape.reset}\n{prefix}\n')
+        output.append(f'{prefix}\n{escape.italic}[Caused by]{escape.reset}\n{prefix}\n')
       case 'context':
-        file.write(f'{prefix}\n{escape.italic}[Raised while handling]{escape.reset}\n{prefix}\n')
+        output.append(f'{prefix}\n{escape.italic}[Raised while handling]{escape.reset}\n{prefix}\n')
 
 
     # Write exception message
 
-    file.write(f'{prefix_first}{type(exc).__name__}: {exc}\n')
+    output.append(f'{prefix_first}{type(exc).__name__}: {exc}\n')
 
 
-    # List frames
+    # List frames, innermost first
 
     current_tb = exc.__traceback__
-    tbs = list[TracebackType]()
+    tbs = deque[TracebackType]()
 
     while current_tb:
-      tbs.append(current_tb)
+      tbs.appendleft(current_tb)
       current_tb = current_tb.tb_next
 
 
@@ -350,12 +449,14 @@ def write_exc_core(start_exc: BaseException, file: IO[str], *, escape: EscapeSeq
     is_syntax_error = isinstance(exc, SyntaxError)
 
     if is_syntax_error:
-      file.write(format_frame(
+      write_frame(
+        output,
         escape=escape,
         frame_index=0,
-        func_name=Path(exc.filename).name,
+        func_name=os.path.basename(exc.filename),
         prefix=prefix,
         raw_path=exc.filename,
+        line_number=exc.lineno,
         positions=(
           exc.lineno,
           exc.end_lineno,
@@ -364,27 +465,38 @@ def write_exc_core(start_exc: BaseException, file: IO[str], *, escape: EscapeSeq
             (exc.end_offset - 1) if exc.end_offset > 0 else exc.offset
           ) if exc.end_offset is not None else None
         ),
-        options=options
-      ))
+        options=options,
+        cache=cache
+      )
 
-    for tb_index, tb in enumerate(reversed(tbs)):
+    for tb_index, tb in enumerate(tbs):
       frame = tb.tb_frame
       frame_code = frame.f_code
       raw_path = frame_code.co_filename
+      frame_index = tb_index + (1 if is_syntax_error else 0)
+
+      # Positions are only needed to display the source, the line number is enough otherwise
+      if frame_index < TRACED_FRAME_COUNT:
+        code_positions = get_code_positions(frame_code)
 
-      positions = next(
-        itertools.islice(frame_code.co_positions(), tb.tb_lasti // 2, None)
-      ) if tb.tb_lasti >= 0 else None
+        # Instructions are two bytes long
+        position_index = tb.tb_lasti // 2
+        positions = code_positions[position_index] if 0 <= position_index < len(code_positions) else None
+      else:
+        positions = None
 
-      file.write(format_frame(
+      write_frame(
+        output,
         escape=escape,
-        frame_index=(tb_index + (1 if is_syntax_error else 0)),
+        frame_index=frame_index,
         func_name=frame_code.co_qualname,
         prefix=prefix,
         raw_path=raw_path,
+        line_number=(tb.tb_lineno if tb.tb_lasti >= 0 else None),
         positions=positions,
-        options=options
-      ))
+        options=options,
+        cache=cache
+      )
 
 
 def dump(
@@ -395,9 +507,13 @@ def dump(
     disable_color: bool = False,
     options: Options = Options()
   ):
-  escape = EscapeSequences(file, disable_color=disable_color)
+  escape = get_escape_sequences(file, disable_color=disable_color)
+
+  output = list[str]()
+  write_exc(start_exc, output, escape=escape, options=options, prefix='', cache=Cache())
 
-  write_exc(start_exc, file, escape=escape, options=options, prefix='')
+  # Write everything at once as the file may be line-buffered, e.g. sys.stderr
+  file.write(''.join(output))
 
 
 def install(file: IO[str] = sys.stderr):
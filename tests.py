@@ -111,6 +111,25 @@ def test10():
   A()
 
 
+# Code compiled with an empty file name
+
+def test11():
+  exec(compile('1/0', '', 'exec'))
+
+
+# Stream without isatty()
+
+def test12():
+  class Writer:
+    def write(self, text: str):
+      sys.stdout.write(text)
+
+  try:
+    raise Exception
+  except Exception as e:
+    dump(e, Writer()) # type: ignore
+
+
 # ---
 
 
@@ -124,6 +143,8 @@ for test in [
   test7,
   test8,
   test9,
+  test11,
+  test12,
 ]:
   print(f'-- {test.__name__} {'-' * 80}')
 